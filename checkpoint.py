@@ -0,0 +1,141 @@
+import os
+import random
+import tempfile
+
+import numpy as np
+
+from city import (City,
+                  CityLocation,
+                  CityLocationType,
+                  GeoLocation, )
+
+# The answers to the prompts of ped_collisions.main that a checkpoint keeps.
+SETTINGS = ("size", "num_simuls", "min_num_peds", "max_num_peds", "node_capacity", "output_grid", "output_graph",
+            "num_sites", "coverage_radius")
+
+
+class SimulationCheckpoint(object):
+    """
+    The state of a run of ped_collisions.main between two simulations: the answers to its prompts, the city, the top
+    location of every run so far, the foot traffic summed over them and the state of the random number generator.
+    Resuming from a checkpoint runs the remaining simulations exactly as the uninterrupted run would have.
+
+    Checkpoints are compressed NumPy archives. They are written to a temporary file that then replaces the previous
+    checkpoint, so a crash while saving leaves the previous checkpoint intact. The top locations are converted to
+    arrays as simulations complete, so saving does not redo the earlier simulations each time.
+
+    >>> random.seed(4)
+    >>> city = City.generate_random_city(10, 10)
+    >>> checkpoint = SimulationCheckpoint(dict.fromkeys(SETTINGS, 1), city)
+    >>> busiest = city.grid_map[2][3]
+    >>> checkpoint.simulation_summary[1] = {5: {"Pedestrians": 5, "City": city, "Top_Location": busiest,
+    ...                                         "Number_Collisions": 4}}
+    >>> checkpoint.foot_traffic[busiest] = 4
+    >>> path = os.path.join(tempfile.mkdtemp(), "simulation.checkpoint")
+    >>> checkpoint.save(path)
+    >>> next_number = random.random()
+    >>> resumed = SimulationCheckpoint.load(path)
+    >>> resumed.simulation_summary[1][5]["Top_Location"] is resumed.city.grid_map[2][3]
+    True
+    >>> resumed.simulation_summary[1][5]["Number_Collisions"], resumed.foot_traffic
+    (4, {business, (2, 3): 4})
+    >>> random.setstate(resumed.random_state)
+    >>> random.random() == next_number
+    True
+    """
+
+    def __init__(self, settings: dict, city: City, simulation_summary: dict = None, foot_traffic: dict = None,
+                 random_state: tuple = None):
+        """
+        :param settings: The answers to the prompts of main, keyed by the names in SETTINGS
+        :param city: The city being simulated
+        :param simulation_summary: The top location of each run, per simulation, as kept by main
+        :param foot_traffic: Per location counts summed over the simulations so far
+        :param random_state: The state of the random number generator after the simulations so far
+        """
+        self.settings = settings
+        self.city = city
+        self.simulation_summary = simulation_summary if simulation_summary is not None else {}
+        self.foot_traffic = foot_traffic if foot_traffic is not None else {}
+        self.random_state = random_state
+        self.cell_of = {id(location): (row, column) for row, locations in enumerate(city.grid_map)
+                        for column, location in enumerate(locations)}
+        self.top_locations = []
+        self.converted = 0
+
+    def save(self, path: str):
+        """
+        Saves the checkpoint to path, along with the current state of the random number generator.
+        """
+        self.random_state = random.getstate()
+        version, key, gauss_next = self.random_state
+
+        while self.converted < len(self.simulation_summary):
+            self.converted += 1
+            self.top_locations.append(np.array(
+                [(self.converted, num_peds) + self.cell_of[id(summary["Top_Location"])] +
+                 (summary["Number_Collisions"],)
+                 for num_peds, summary in self.simulation_summary[self.converted].items()],
+                dtype=np.int64).reshape(-1, 5))
+
+        arrays = {"setting_" + name: np.int64(self.settings[name]) for name in SETTINGS}
+        arrays["layout"] = np.array([[location.location_type.value for location in row]
+                                     for row in self.city.grid_map], dtype=np.uint8)
+        arrays["simulations"] = np.int64(len(self.simulation_summary))
+        arrays["top_locations"] = np.concatenate(self.top_locations) if self.top_locations else np.zeros(
+            (0, 5), dtype=np.int64)
+        arrays["traffic_cells"] = np.array([self.cell_of[id(location)] for location in self.foot_traffic],
+                                           dtype=np.int32).reshape(-1, 2)
+        arrays["traffic_counts"] = np.fromiter(self.foot_traffic.values(), dtype=np.int64,
+                                               count=len(self.foot_traffic))
+        arrays["random_version"] = np.int64(version)
+        arrays["random_key"] = np.array(key, dtype=np.uint32)
+        arrays["random_gauss"] = np.float64(np.nan if gauss_next is None else gauss_next)
+
+        handle, temporary_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as checkpoint_file:
+                np.savez_compressed(checkpoint_file, **arrays)
+                checkpoint_file.flush()
+                os.fsync(checkpoint_file.fileno())
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Loads a checkpoint saved by save, rebuilding the city and the summaries of the simulations so far.
+
+        :param path: Where the checkpoint was saved
+        :return: A SimulationCheckpoint
+        """
+        with np.load(path) as arrays:
+            settings = {name: int(arrays["setting_" + name]) for name in SETTINGS}
+            layout = arrays["layout"]
+            simulations = int(arrays["simulations"])
+            top_locations = arrays["top_locations"]
+            traffic_cells, traffic_counts = arrays["traffic_cells"], arrays["traffic_counts"]
+            gauss_next = float(arrays["random_gauss"])
+            random_state = (int(arrays["random_version"]), tuple(int(word) for word in arrays["random_key"]),
+                            None if np.isnan(gauss_next) else gauss_next)
+
+        city = City([[CityLocation(GeoLocation(row, column), CityLocationType(int(layout[row, column])))
+                      for column in range(layout.shape[1])] for row in range(layout.shape[0])])
+
+        simulation_summary = {simulation: {} for simulation in range(1, simulations + 1)}
+        for simulation, num_peds, row, column, collisions in top_locations.tolist():
+            simulation_summary[simulation][num_peds] = {
+                "Pedestrians": num_peds,
+                "City": city,
+                "Top_Location": city.grid_map[row][column],
+                "Number_Collisions": collisions
+            }
+        foot_traffic = {city.grid_map[row][column]: count
+                        for (row, column), count in zip(traffic_cells.tolist(), traffic_counts.tolist())}
+
+        checkpoint = SimulationCheckpoint(settings, city, simulation_summary, foot_traffic, random_state)
+        checkpoint.top_locations = [top_locations]
+        checkpoint.converted = simulations
+        return checkpoint
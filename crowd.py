@@ -0,0 +1,351 @@
+from enum import IntEnum
+from typing import (List,
+                    Tuple, )
+
+import numpy as np
+
+from city import (City,
+                  CityLocation, )
+
+
+class AgentState(IntEnum):
+    """
+    Represents what a pedestrian in a crowd simulation did on the last tick.
+    """
+    walking = 0
+    waiting = 1
+    arrived = 2
+
+
+class CrowdSimulation(object):
+    """
+    A time-stepped simulation of pedestrians walking their paths through a city at the same time.
+
+    Every pedestrian's position, path cursor and state are kept in NumPy arrays indexed by pedestrian, and each tick
+    advances all of them together. A city location can hold at most node_capacity pedestrians; pedestrians that cannot
+    step into a full location wait, and after waiting patience ticks they take a detour of at most max_detour blocks
+    around the full locations that rejoins their path further ahead. Destinations always accept arriving pedestrians,
+    who then leave the simulation.
+
+    Like run_simulation, the simulation counts how many times each location is walked through, excluding start and
+    destination locations. With unlimited capacity nobody waits or reroutes, so the counts are the same as
+    run_simulation for the same pedestrians.
+
+    >>> import random
+    >>> from pedestrian import Pedestrian
+    >>> random.seed(7)
+    >>> city = City.generate_random_city(10, 10)
+    >>> pedestrians = Pedestrian.generate_random_pedestrians(20, city)
+    >>> static_counts = {}
+    >>> for ped in pedestrians:
+    ...     for location in ped.shortest_path[1:-1]:
+    ...         static_counts[location] = static_counts.get(location, 0) + 1
+    >>> crowd = CrowdSimulation.from_pedestrians(city, pedestrians)
+    >>> crowd.run() == max(len(ped.shortest_path) for ped in pedestrians) - 1
+    True
+    >>> crowd.foot_traffic() == sorted(static_counts.items(), key=lambda x: x[1], reverse=True)
+    True
+
+    Two pedestrians heading for the same location one block away: with room for one, the second one waits a tick.
+
+    >>> from city import GeoLocation, CityLocationType
+    >>> grid = [[CityLocation(GeoLocation(row, column), CityLocationType.walkway) for column in range(3)]
+    ...         for row in range(2)]
+    >>> crowd = CrowdSimulation(City(grid), [[grid[0][0], grid[0][1], grid[0][2]],
+    ...                                      [grid[1][1], grid[0][1], grid[0][2]]], node_capacity=1)
+    >>> crowd.step()
+    2
+    >>> [AgentState(state).name for state in crowd.state]
+    ['walking', 'waiting']
+    >>> crowd.run()
+    3
+    >>> crowd.foot_traffic()
+    [(walkway, (0, 1), 2)]
+
+    Two pedestrians trying to swap places with room for one each are stuck until they give up and take detours.
+
+    >>> grid = [[CityLocation(GeoLocation(row, column), CityLocationType.walkway) for column in range(3)]
+    ...         for row in range(3)]
+    >>> crowd = CrowdSimulation(City(grid), [[grid[0][0], grid[0][1], grid[0][2]],
+    ...                                      [grid[0][1], grid[0][0], grid[1][0]]], node_capacity=1, patience=2)
+    >>> crowd.run()
+    6
+    >>> crowd.foot_traffic()
+    [(walkway, (1, 1), 2), (walkway, (1, 0), 1), (walkway, (1, 2), 1)]
+
+    In a corridor there is no way around, so the simulation stops once the pedestrians are gridlocked.
+
+    >>> corridor = [[CityLocation(GeoLocation(0, column), CityLocationType.walkway) for column in range(4)]]
+    >>> crowd = CrowdSimulation(City(corridor), [corridor[0][1:], corridor[0][2::-1]], node_capacity=1, patience=2)
+    >>> crowd.run()
+    3
+    >>> [AgentState(state).name for state in crowd.state]
+    ['waiting', 'waiting']
+
+    Pedestrians can also end up detouring around each other back and forth forever; the simulation stops once none of
+    them gets any further along its path.
+
+    >>> random.seed(1)
+    >>> city = City.generate_random_city(20, 20)
+    >>> crowd = CrowdSimulation.from_pedestrians(city, Pedestrian.generate_random_pedestrians(40, city), 1)
+    >>> crowd.run() < 200
+    True
+    >>> int(np.count_nonzero(crowd.state != AgentState.arrived))
+    5
+    """
+
+    def __init__(self, city: City, paths: List[List[CityLocation]], node_capacity: int = 0, patience: int = 3,
+                 max_detour: int = 8):
+        """
+        :param city: The city the pedestrians walk in
+        :param paths: The path of each pedestrian, from its start location to its destination
+        :param node_capacity: The most pedestrians a location can hold at once, 0 for unlimited
+        :param patience: Ticks a pedestrian waits before being rerouted, 0 to never reroute
+        :param max_detour: The most blocks a detour may take before rejoining the pedestrian's path
+        """
+        self.locations = [location for row in city.grid_map for location in row]
+        rows, columns = len(city.grid_map), len(city.grid_map[0])
+        num_locations = len(self.locations)
+        node_of = {id(location): node for node, location in enumerate(self.locations)}
+
+        blocked = np.array([location.is_blocked() for location in self.locations], dtype=bool)
+        self.neighbours = self.grid_neighbours(rows, columns)
+        self.neighbours[blocked[np.maximum(self.neighbours, 0)] | blocked[:, None]] = -1
+
+        lengths = np.array([len(path) for path in paths], dtype=np.int64)
+        self.path_nodes = np.fromiter((node_of[id(location)] for path in paths for location in path), dtype=np.int64,
+                                      count=int(lengths.sum()))
+        self.cursor = np.cumsum(lengths) - lengths
+        self.path_end = self.cursor + lengths - 1
+        self.position = self.path_nodes[self.cursor]
+        self.destination = self.path_nodes[self.path_end]
+        self.waiting = np.zeros(len(paths), dtype=np.int64)
+        self.state = np.where(lengths > 1, AgentState.walking, AgentState.arrived).astype(np.int8)
+
+        self.capacity = np.full(num_locations, node_capacity if node_capacity > 0 else len(paths) + 1, dtype=np.int64)
+        self.patience = patience
+
+        """
+        A detour is walked instead of the path while detour_cursor < detour_length. It ends at the path node at index
+        rejoin, after which the pedestrian carries on along its path from there.
+        """
+        self.max_detour = max_detour
+        self.detour = np.zeros((len(paths), max(1, max_detour)), dtype=np.int64)
+        self.detour_length = np.zeros(len(paths), dtype=np.int64)
+        self.detour_cursor = np.zeros(len(paths), dtype=np.int64)
+        self.rejoin = np.zeros(len(paths), dtype=np.int64)
+
+        # Locations are ranked by where they first appear inside a path, as run_simulation meets them, to break ties
+        # between counts the same way; locations only walked through on detours come after all of those.
+        interior = np.ones(len(self.path_nodes), dtype=bool)
+        interior[self.cursor] = False
+        interior[self.path_end] = False
+        self.first_seen = np.full(num_locations, len(self.path_nodes), dtype=np.int64) + np.arange(num_locations)
+        seen, first = np.unique(self.path_nodes[interior], return_index=True)
+        self.first_seen[seen] = first
+
+        self.counts = np.zeros(num_locations, dtype=np.int64)
+        self.tick = 0
+        self.moved = 0
+
+    @classmethod
+    def from_pedestrians(cls, city: City, pedestrians: List, node_capacity: int = 0, patience: int = 3,
+                         max_detour: int = 8):
+        """
+        Builds a crowd simulation of pedestrians generated by Pedestrian.generate_random_pedestrians.
+
+        :param city: The city the pedestrians walk in
+        :param pedestrians: The pedestrians, each walking its shortest path
+        :param node_capacity: The most pedestrians a location can hold at once, 0 for unlimited
+        :param patience: Ticks a pedestrian waits before being rerouted, 0 to never reroute
+        :param max_detour: The most blocks a detour may take before rejoining the pedestrian's path
+        :return: A CrowdSimulation at tick 0
+        """
+        return CrowdSimulation(city, [ped.shortest_path for ped in pedestrians], node_capacity, patience, max_detour)
+
+    @classmethod
+    def grid_neighbours(cls, rows: int, columns: int) -> np.ndarray:
+        """
+        The up to four adjacent locations of every location of a rows x columns grid, -1 where there is none.
+
+        >>> CrowdSimulation.grid_neighbours(2, 2)
+        array([[-1,  2, -1,  1],
+               [-1,  3,  0, -1],
+               [ 0, -1, -1,  3],
+               [ 1, -1,  2, -1]])
+        """
+        node = np.arange(rows * columns).reshape(rows, columns)
+        neighbours = np.full((rows, columns, 4), -1, dtype=np.int64)
+        neighbours[1:, :, 0] = node[:-1, :]
+        neighbours[:-1, :, 1] = node[1:, :]
+        neighbours[:, 1:, 2] = node[:, :-1]
+        neighbours[:, :-1, 3] = node[:, 1:]
+        return neighbours.reshape(rows * columns, 4)
+
+    def step(self) -> int:
+        """
+        Advances every pedestrian by one tick.
+
+        Pedestrians stepping into the same location are let in in order of how long they have waited (then in order
+        of pedestrian), as long as the location has room counting the pedestrians standing in it that are not about to
+        arrive at their destination.
+
+        :return: Number of pedestrians still walking or waiting
+        """
+        active = np.flatnonzero(self.state != AgentState.arrived)
+        self.moved = 0
+        if len(active) == 0:
+            return 0
+
+        in_detour = self.detour_cursor[active] < self.detour_length[active]
+        target = self.path_nodes[self.cursor[active] + 1]
+        target[in_detour] = self.detour[active[in_detour], self.detour_cursor[active[in_detour]]]
+        arriving = target == self.destination[active]
+        occupancy = np.bincount(self.position[active[~arriving]], minlength=len(self.locations))
+
+        order = np.lexsort((active, -self.waiting[active], target))
+        sorted_target = target[order]
+        group_start = np.flatnonzero(np.concatenate(([True], sorted_target[1:] != sorted_target[:-1])))
+        rank = np.arange(len(order)) - np.repeat(group_start, np.diff(np.append(group_start, len(order))))
+        admitted = np.empty(len(order), dtype=bool)
+        admitted[order] = rank < (self.capacity - occupancy)[sorted_target]
+        admitted |= arriving
+
+        moved = active[admitted]
+        self.moved = len(moved)
+        self.cursor[active[admitted & ~in_detour]] += 1
+        detouring = active[admitted & in_detour]
+        self.detour_cursor[detouring] += 1
+        rejoined = detouring[self.detour_cursor[detouring] == self.detour_length[detouring]]
+        self.cursor[rejoined] = self.rejoin[rejoined]
+        self.detour_length[rejoined] = 0
+        self.detour_cursor[rejoined] = 0
+        self.position[moved] = target[admitted]
+        self.waiting[moved] = 0
+        self.state[moved] = AgentState.walking
+        self.state[active[admitted & arriving]] = AgentState.arrived
+        np.add.at(self.counts, target[admitted & ~arriving], 1)
+
+        stuck = active[~admitted]
+        self.waiting[stuck] += 1
+        self.state[stuck] = AgentState.waiting
+        if self.patience > 0 and self.max_detour > 0:
+            impatient = stuck[self.waiting[stuck] >= self.patience]
+            if len(impatient):
+                self.reroute(impatient, occupancy < self.capacity)
+
+        self.tick += 1
+        return len(active) - int(np.count_nonzero(admitted & arriving))
+
+    def run(self, max_ticks: int = None) -> int:
+        """
+        Steps the simulation until every pedestrian has arrived, max_ticks ticks have passed, or the pedestrians left
+        are gridlocked. Once nobody has moved for more than patience ticks, every waiting pedestrian has failed to find
+        a detour with the locations as full as they are, so nobody ever will move again.
+
+        Pedestrians can also be gridlocked while moving, taking detours around each other back and forth without
+        getting any further along their paths. A pedestrian gets further along its path within patience ticks of
+        waiting plus max_detour ticks of detour, so once no path cursor has advanced for twice that long the
+        simulation stops as well.
+
+        :param max_ticks: The most ticks to run, None for no limit
+        :return: The tick the simulation stopped at
+        """
+        stall_limit = 2 * (self.patience + self.max_detour)
+        idle_ticks = stalled_ticks = 0
+        progress = int(self.cursor.sum())
+        while (max_ticks is None or self.tick < max_ticks) and idle_ticks <= self.patience and \
+                stalled_ticks <= stall_limit and self.step() > 0:
+            idle_ticks = idle_ticks + 1 if self.moved == 0 else 0
+            progress, last_progress = int(self.cursor.sum()), progress
+            stalled_ticks = stalled_ticks + 1 if progress == last_progress else 0
+        return self.tick
+
+    def reroute(self, agents: np.ndarray, has_room: np.ndarray):
+        """
+        Looks for a detour of at most max_detour blocks through locations with room, from each given pedestrian's
+        position to a location up to 2 * max_detour steps further along its path. All the pedestrians are searched
+        together, one breadth first frontier of (pedestrian, location) pairs per block of detour. Pedestrians for which
+        there is no such detour keep their path and start waiting again.
+
+        :param agents: Indices of the pedestrians to reroute
+        :param has_room: Per location, whether it can take another pedestrian
+        """
+        num_locations = len(self.locations)
+        self.waiting[agents] = 0
+
+        # Path indices the detour may rejoin at: past the next step, or past the end of the detour being abandoned.
+        in_detour = self.detour_cursor[agents] < self.detour_length[agents]
+        base = np.where(in_detour, self.rejoin[agents] - 1, self.cursor[agents] + 1)
+        ahead = base[:, None] + np.arange(1, 2 * self.max_detour + 1)[None, :]
+        ahead = np.minimum(ahead, self.path_end[agents][:, None])
+        goal_keys = np.arange(len(agents))[:, None] * num_locations + self.path_nodes[ahead]
+        goal_keys, first = np.unique(goal_keys.ravel(), return_index=True)
+        goal_index = ahead.ravel()[first]
+
+        """
+        levels[depth - 1] holds the (pedestrian slot, location, parent entry in the previous level) of every location
+        first reached after depth blocks, the pedestrian's position being level 0.
+        """
+        slots = np.arange(len(agents))
+        nodes = self.position[agents]
+        levels = [(slots, nodes, slots)]
+        frontier = slots
+
+        # The grid is bipartite, so a location next to one first reached after depth - 1 blocks was either first
+        # reached after depth - 2 blocks or is reached now; only the keys of those two levels need to be kept.
+        behind, current = np.array([], dtype=np.int64), slots * num_locations + nodes
+        found = np.zeros(len(agents), dtype=bool)
+
+        for depth in range(1, self.max_detour + 1):
+            parents = np.repeat(frontier, 4)
+            slots, nodes = levels[-1][0][parents], self.neighbours[levels[-1][1][frontier]].ravel()
+            keep = nodes >= 0
+            keep[keep] = has_room[nodes[keep]] | (nodes[keep] == self.destination[agents[slots[keep]]])
+            keys, unique = np.unique(slots[keep] * num_locations + nodes[keep], return_index=True)
+            fresh = ~np.isin(keys, behind, assume_unique=True)
+            entries = np.flatnonzero(keep)[unique[fresh]]
+            levels.append((slots[entries], nodes[entries], parents[entries]))
+            behind, current = current, keys[fresh]
+            slots, nodes = levels[-1][0], levels[-1][1]
+
+            goal = np.minimum(np.searchsorted(goal_keys, keys[fresh]), len(goal_keys) - 1)
+            hit = np.flatnonzero(goal_keys[goal] == keys[fresh])
+            hit_slots, first_hit = np.unique(slots[hit], return_index=True)
+            hit = hit[first_hit]
+            if len(hit):
+                self.start_detours(agents[hit_slots], levels, hit, goal_index[goal[hit]])
+                found[hit_slots] = True
+
+            frontier = np.flatnonzero(~found[slots])
+            if len(frontier) == 0:
+                break
+
+    def start_detours(self, agents: np.ndarray, levels: List[Tuple], entries: np.ndarray, rejoin: np.ndarray):
+        """
+        Traces detours found by reroute back from the location they rejoin the path at to the pedestrians' positions.
+
+        :param agents: The pedestrians the detours are for
+        :param levels: The search levels of reroute, the last level holding the rejoining locations
+        :param entries: Per pedestrian, the entry of its rejoining location in the last level
+        :param rejoin: Per pedestrian, the path index of its rejoining location
+        """
+        length = len(levels) - 1
+        for depth in range(length, 0, -1):
+            slots, nodes, parents = levels[depth]
+            self.detour[agents, depth - 1] = nodes[entries]
+            entries = parents[entries]
+        self.detour_length[agents] = length
+        self.detour_cursor[agents] = 0
+        self.rejoin[agents] = rejoin
+
+    def foot_traffic(self) -> List[Tuple[CityLocation, int]]:
+        """
+        How many times each location was walked through so far, in the same form and order as run_simulation: ties
+        are broken by where the locations first appear inside the pedestrians' paths.
+
+        :return: (location, count) pairs, most walked through first
+        """
+        walked = np.flatnonzero(self.counts)
+        walked = walked[np.lexsort((self.first_seen[walked], -self.counts[walked]))]
+        return [(self.locations[node], int(self.counts[node])) for node in walked]
@@ -0,0 +1,543 @@
+"""
+A local job server for running simulations from dashboards and notebooks.
+
+Jobs are run on a pool of worker processes, one simulation per task, and stream progress and the foot traffic so far
+(as a heatmap) while they run. Finished results are kept in an on-disk cache addressed by a hash of the city layout
+and the job parameters, so asking for the same job again is answered from disk. Everything runs on this machine:
+clients connect over a localhost socket, or use SimulationService directly in-process.
+
+Run with: python job_service.py --port 8765
+"""
+
+# !/usr/bin/python3
+
+import argparse
+import asyncio
+import collections
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import (AsyncIterator,
+                    Dict,
+                    List, )
+
+import pedestrian
+from city import (City,
+                  CityLocation,
+                  CityLocationType,
+                  GeoLocation, )
+from ped_collisions import (TILED_ROUTING_MIN_GRID_SIZE,
+                            run_pedestrian_range, )
+from routing import TiledRouter
+
+# The longest line of JSON the server and client read. Jobs carry their whole layout and events their whole heatmap on
+# one line, which for metro-scale grids is far beyond the 64 KiB asyncio streams allow by default.
+MAX_LINE_BYTES = 256 * 1024 * 1024
+
+# The parameters a job may have, and their defaults (None for required ones).
+JOB_PARAMETERS = {"layout": None, "min_peds": None, "max_peds": None, "num_simuls": None, "seed": None,
+                  "node_capacity": 0}
+
+
+def layout_of(city: City) -> List[List[str]]:
+    """
+    The location types of a city grid, row by row.
+
+    >>> layout_of(City([[CityLocation(GeoLocation(0, 0), CityLocationType.residence),
+    ... CityLocation(GeoLocation(0, 1), CityLocationType.blockage)]]))
+    [['residence', 'blockage']]
+    """
+    return [[location.location_type.name for location in row] for row in city.grid_map]
+
+
+def city_from_layout(layout: List[List[str]]) -> City:
+    """
+    Builds the city described by a layout as returned by layout_of.
+
+    >>> city_from_layout([['walkway', 'business']]).grid_map
+    [[walkway, (0, 0), business, (0, 1)]]
+    """
+    return City([[CityLocation(GeoLocation(row, column), CityLocationType[location_type])
+                  for column, location_type in enumerate(locations)] for row, locations in enumerate(layout)])
+
+
+def layout_digest(layout: List[List[str]]) -> str:
+    """
+    A hash identifying a city layout.
+
+    >>> layout_digest([['walkway', 'business']]) == layout_digest([['walkway', 'business']])
+    True
+    >>> layout_digest([['walkway', 'business']]) == layout_digest([['walkway'], ['business']])
+    False
+    """
+    return hashlib.sha256(json.dumps(layout, separators=(",", ":")).encode()).hexdigest()
+
+
+def job_key(job: dict) -> str:
+    """
+    The cache key of a job: a hash of its city layout and every other parameter.
+    """
+    parameters = {name: job[name] for name in JOB_PARAMETERS if name != "layout"}
+    parameters["city"] = layout_digest(job["layout"])
+    return hashlib.sha256(json.dumps(parameters, sort_keys=True).encode()).hexdigest()
+
+
+def validate_job(job: dict) -> dict:
+    """
+    Fills in defaults for a job and checks its parameters.
+
+    >>> job = validate_job({"layout": [["walkway"] * 3], "min_peds": 1, "max_peds": 2, "num_simuls": 5, "seed": 1})
+    >>> job["node_capacity"]
+    0
+    >>> validate_job({"layout": [["walkway"]], "min_peds": 1, "max_peds": 2, "num_simuls": 5})
+    Traceback (most recent call last):
+    ...
+    ValueError: Missing job parameter: seed
+    >>> validate_job({"layout": [["residence", "residence", "walkway"]], "min_peds": 1, "max_peds": 2, "num_simuls": 5,
+    ...               "seed": 1})
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid pedestrian range for this layout, which has room for at most 1 pedestrians
+
+    :param job: The job as submitted
+    :return: The job with every parameter set
+    """
+    job = {name: job.get(name, default) for name, default in JOB_PARAMETERS.items()}
+    for name, value in job.items():
+        if value is None:
+            raise ValueError("Missing job parameter: {}".format(name))
+
+    layout = job["layout"]
+    if not layout or not layout[0] or any(len(row) != len(layout[0]) for row in layout):
+        raise ValueError("The layout must be a non-empty rectangular grid")
+    if any(location_type not in CityLocationType.__members__ for row in layout for location_type in row):
+        raise ValueError("Unknown location type in layout")
+    for name in ("min_peds", "max_peds", "num_simuls", "seed", "node_capacity"):
+        if not isinstance(job[name], int):
+            raise ValueError("Job parameter {} must be an integer".format(name))
+
+    # Every pedestrian needs a start (residence or walkway) and a destination (business or walkway) of its own.
+    counts = collections.Counter(location_type for row in layout for location_type in row)
+    most_peds = min(counts["residence"], counts["business"]) + counts["walkway"]
+    if not 1 <= job["min_peds"] <= job["max_peds"] <= most_peds:
+        raise ValueError("Invalid pedestrian range for this layout, which has room for at most {} pedestrians".format(
+            most_peds))
+    if job["num_simuls"] < 1 or job["node_capacity"] < 0:
+        raise ValueError("Invalid number of simulations or node capacity")
+    return job
+
+
+# The city (and router) a worker process last simulated, by layout digest.
+worker_city = {}
+
+
+def simulate(digest: str, layout_path: str, min_peds: int, max_peds: int, node_capacity: int, seed: int,
+             simulation: int) -> tuple:
+    """
+    Runs one simulation of a job in a worker. Each simulation is seeded from the job seed and its number, so the
+    result does not depend on which worker runs it or when.
+
+    Only the digest of the layout is sent with each simulation; a worker reads the layout itself from layout_path the
+    first time it simulates that city, rather than every simulation of a job shipping the whole layout to it.
+
+    :return: (simulation, list of (pedestrians, row, column, count) top locations, dict of (row, column) to count)
+    """
+    if digest not in worker_city:
+        worker_city.clear()
+        pedestrian.path_cache.clear()
+        with open(layout_path) as layout_file:
+            layout = json.load(layout_file)
+        city = city_from_layout(layout)
+        router = TiledRouter(city) if min(len(layout), len(layout[0])) >= TILED_ROUTING_MIN_GRID_SIZE else None
+        worker_city[digest] = (city, router)
+    city, router = worker_city[digest]
+
+    random.seed("{}:{}".format(seed, simulation))
+    foot_traffic = {}
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            pedestrian_summary = run_pedestrian_range(city, min_peds, max_peds, node_capacity, router, foot_traffic)
+    except SystemExit:
+        # generate_random_pedestrians exits when there are fewer start locations than pedestrians.
+        raise ValueError("The city cannot accommodate {} pedestrians".format(max_peds))
+
+    top_locations = [(num_peds, summary["Top_Location"].geo_location.latitude,
+                      summary["Top_Location"].geo_location.longitude, summary["Number_Collisions"])
+                     for num_peds, summary in pedestrian_summary.items()]
+    return simulation, top_locations, {(location.geo_location.latitude, location.geo_location.longitude): count
+                                       for location, count in foot_traffic.items()}
+
+
+def heatmap(foot_traffic: Dict[tuple, int]) -> List[List[int]]:
+    """
+    Foot traffic as [row, column, count] triples, busiest first.
+
+    >>> heatmap({(0, 1): 2, (3, 4): 5})
+    [[3, 4, 5], [0, 1, 2]]
+    """
+    return [[row, column, count] for (row, column), count in
+            sorted(foot_traffic.items(), key=lambda item: (-item[1], item[0]))]
+
+
+class ResultCache(object):
+    """
+    Job results on disk, one gzipped JSON file per job named after its key. Reading a result marks it as recently
+    used, and once the files take up more than max_bytes the least recently used ones are removed.
+
+    The result just stored is never removed, so a cache too small for two results keeps only the latest one.
+
+    >>> cache = ResultCache(tempfile.mkdtemp(), max_bytes=1)
+    >>> cache.put("a" * 64, {"foot_traffic": [[0, 0, 1]]})
+    >>> cache.get("a" * 64)
+    {'foot_traffic': [[0, 0, 1]]}
+    >>> cache.put("b" * 64, {"foot_traffic": [[0, 0, 2]]})
+    >>> cache.get("a" * 64) is None, cache.get("b" * 64) is None
+    (True, False)
+    >>> cache.evict()
+    >>> cache.get("b" * 64) is None
+    True
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json.gz")
+
+    def get(self, key: str):
+        try:
+            with gzip.open(self.path(key), "rt") as result_file:
+                result = json.load(result_file)
+        except (OSError, ValueError):
+            return None
+        with contextlib.suppress(OSError):
+            os.utime(self.path(key))
+        return result
+
+    def put(self, key: str, result: dict):
+        """
+        Stores a result, writing it to a temporary file first so a result file is never seen half written.
+        """
+        handle, temporary_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(handle, "wb") as raw_file, gzip.GzipFile(fileobj=raw_file, mode="wb") as result_file:
+            result_file.write(json.dumps(result, separators=(",", ":")).encode())
+        os.replace(temporary_path, self.path(key))
+        self.evict(keep=key)
+
+    def evict(self, keep: str = None):
+        """
+        Removes the least recently used results until the cache fits in max_bytes, except for the result keyed keep.
+        """
+        keep_path = self.path(keep) if keep is not None else None
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json.gz"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path != keep_path:
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+                total -= size
+
+
+class SimulationJob(object):
+    """
+    A submitted job, along with every event it has published so far.
+    """
+
+    def __init__(self, key: str, job: dict):
+        self.key = key
+        self.job = job
+        self.events = []
+        self.finished = False
+        self.changed = asyncio.Condition()
+
+    async def publish(self, event: dict, finished: bool = False):
+        async with self.changed:
+            self.events.append(event)
+            self.finished = self.finished or finished
+            self.changed.notify_all()
+
+    async def stream(self) -> AsyncIterator[dict]:
+        """
+        Yields every event of the job, from the first one, until the job is finished.
+        """
+        seen = 0
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(lambda: len(self.events) > seen or self.finished)
+                events, finished = self.events[seen:], self.finished
+            for event in events:
+                yield event
+            seen += len(events)
+            if finished and seen == len(self.events):
+                return
+
+
+class SimulationService(object):
+    """
+    Runs simulation jobs on a worker pool and caches their results.
+
+    A job is a dict with the city "layout" (see layout_of), "min_peds", "max_peds", "num_simuls", "seed" and
+    optionally "node_capacity" and "heatmap_every". Running it yields events as JSON-ready dicts:
+
+    - {"event": "progress", "completed": ..., "of": ..., "heatmap": ...} as simulations finish, the heatmap being the
+      foot traffic summed over the finished simulations (only sent every heatmap_every simulations and at the end)
+    - {"event": "done", "cached": ..., "result": ...} once, with result holding the top location of every run and
+      the foot traffic summed over all simulations
+    - {"event": "error", "message": ...} instead, when the job is invalid or fails
+
+    Submitting a job that is already running follows the running job instead of starting it again. Workers are
+    processes by default; for in-process use, pass a single thread executor (simulations seed the global random
+    number generator, so they should not run on several threads at once).
+
+    >>> import asyncio
+    >>> from concurrent.futures import ThreadPoolExecutor
+    >>> service = SimulationService(tempfile.mkdtemp(), executor=ThreadPoolExecutor(1))
+    >>> random.seed(5)
+    >>> job = {"layout": layout_of(City.generate_random_city(10, 10)), "min_peds": 3, "max_peds": 4,
+    ...        "num_simuls": 4, "seed": 11, "heatmap_every": 2}
+    >>> async def collect():
+    ...     return [event async for event in service.run(job)]
+    >>> events = asyncio.run(collect())
+    >>> [(event["event"], event["completed"], "heatmap" in event) for event in events[:-1]]
+    [('progress', 1, False), ('progress', 2, True), ('progress', 3, False), ('progress', 4, True)]
+    >>> events[-1]["event"], events[-1]["cached"], events[-1]["result"]["foot_traffic"] == events[-2]["heatmap"]
+    ('done', False, True)
+    >>> cached = asyncio.run(collect())
+    >>> [event["event"] for event in cached], cached[-1]["cached"], cached[-1]["result"] == events[-1]["result"]
+    (['done'], True, True)
+    >>> async def collect_error():
+    ...     return [event async for event in service.run({"layout": [["walkway"]], "min_peds": 1, "max_peds": 1,
+    ...                                                   "num_simuls": 1})]
+    >>> asyncio.run(collect_error())
+    [{'event': 'error', 'message': 'Missing job parameter: seed'}]
+
+    Over a socket, jobs and events are one line of JSON each, however large the city.
+
+    >>> async def over_socket(job, limit=MAX_LINE_BYTES):
+    ...     server = await service.serve(port=0, limit=limit)
+    ...     async with server:
+    ...         return [event async for event in submit_job(job, port=server.sockets[0].getsockname()[1])]
+    >>> large = {"layout": layout_of(City.generate_random_city(100, 100)), "min_peds": 20, "max_peds": 20,
+    ...          "num_simuls": 2, "seed": 3}
+    >>> len(json.dumps(large)) > 64 * 1024
+    True
+    >>> events = asyncio.run(over_socket(large))
+    >>> [event["event"] for event in events], len(events[-1]["result"]["top_locations"])
+    (['progress', 'progress', 'done'], 2)
+    >>> asyncio.run(over_socket(large, limit=64 * 1024))
+    [{'event': 'error', 'message': 'The job is longer than the server accepts'}]
+    >>> service.close()
+    """
+
+    def __init__(self, cache_directory: str, max_cache_bytes: int = 256 * 1024 * 1024, workers: int = None,
+                 executor=None):
+        """
+        :param cache_directory: Where to keep job results
+        :param max_cache_bytes: How much disk space job results may take up
+        :param workers: The number of worker processes, defaults to the number of processors
+        :param executor: A concurrent.futures executor to run simulations on instead of worker processes
+        """
+        self.cache = ResultCache(cache_directory, max_cache_bytes)
+        self.workers = workers
+        self.executor = executor if executor is not None else self.worker_pool()
+        self.jobs = {}
+
+    def worker_pool(self) -> ProcessPoolExecutor:
+        # Forked workers would inherit open client connections and keep them from closing, so spawn them instead.
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    async def run(self, job: dict) -> AsyncIterator[dict]:
+        """
+        Submits a job and yields its events.
+        """
+        try:
+            heatmap_every = int(job.get("heatmap_every", 0))
+            job = validate_job(job)
+        except (ValueError, TypeError) as e:
+            yield {"event": "error", "message": str(e)}
+            return
+
+        key = job_key(job)
+        if key not in self.jobs:
+            self.jobs[key] = SimulationJob(key, job)
+            asyncio.ensure_future(self.execute(self.jobs[key], max(1, heatmap_every or job["num_simuls"] // 20)))
+        async for event in self.jobs[key].stream():
+            yield event
+
+    async def execute(self, simulation_job: SimulationJob, heatmap_every: int):
+        """
+        Runs a job and publishes its events. Reading and writing the cache and building heatmaps happen on the loop's
+        default executor, so large results do not hold up the streams of other jobs.
+        """
+        job = simulation_job.job
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+        pending, layout_path = [], None
+        try:
+            result = await loop.run_in_executor(None, self.cache.get, simulation_job.key)
+            if result is not None:
+                await simulation_job.publish({"event": "done", "cached": True, "result": result}, finished=True)
+                return
+
+            digest = layout_digest(job["layout"])
+            layout_path = await loop.run_in_executor(None, self.write_layout, job["layout"])
+            pending = [loop.run_in_executor(executor, simulate, digest, layout_path, job["min_peds"], job["max_peds"],
+                                            job["node_capacity"], job["seed"], simulation)
+                       for simulation in range(1, job["num_simuls"] + 1)]
+
+            top_locations, foot_traffic = [], {}
+            for completed, finished in enumerate(asyncio.as_completed(pending), start=1):
+                simulation, simulation_top_locations, simulation_traffic = await finished
+                top_locations.extend([simulation] + list(top_location) for top_location in simulation_top_locations)
+                for cell, count in simulation_traffic.items():
+                    foot_traffic[cell] = foot_traffic.get(cell, 0) + count
+
+                progress = {"event": "progress", "completed": completed, "of": job["num_simuls"]}
+                if completed % heatmap_every == 0 or completed == job["num_simuls"]:
+                    progress["heatmap"] = await loop.run_in_executor(None, heatmap, foot_traffic)
+                await simulation_job.publish(progress)
+
+            result = {"city": digest, "top_locations": sorted(top_locations), "foot_traffic": progress["heatmap"]}
+            await loop.run_in_executor(None, self.cache.put, simulation_job.key, result)
+            await simulation_job.publish({"event": "done", "cached": False, "result": result}, finished=True)
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool) and self.executor is executor:
+                # A worker died and the pool takes no more work, so start a new one for the jobs that follow.
+                self.executor = self.worker_pool()
+                executor.shutdown(wait=False)
+            await simulation_job.publish({"event": "error", "message": str(e) or type(e).__name__}, finished=True)
+        finally:
+            for future in pending:
+                # Simulations left over from a failed job are not needed anymore.
+                if future.done() and not future.cancelled():
+                    future.exception()
+                else:
+                    future.cancel()
+            if layout_path is not None:
+                with contextlib.suppress(OSError):
+                    os.remove(layout_path)
+            self.jobs.pop(simulation_job.key, None)
+
+    def write_layout(self, layout: List[List[str]]) -> str:
+        """
+        Writes a job's layout next to the cached results for its workers to read.
+
+        :return: The path of the layout file
+        """
+        handle, layout_path = tempfile.mkstemp(dir=self.cache.directory, suffix=".layout.json")
+        with os.fdopen(handle, "w") as layout_file:
+            json.dump(layout, layout_file, separators=(",", ":"))
+        return layout_path
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Reads one job as a line of JSON and writes back its events, one line of JSON each.
+        """
+        try:
+            try:
+                line = await reader.readuntil(b"\n")
+            except asyncio.IncompleteReadError as e:
+                line = e.partial
+            except asyncio.LimitOverrunError:
+                # Read past the rest of the line, so the client gets the error rather than a reset connection.
+                while True:
+                    chunk = await reader.read(64 * 1024)
+                    if not chunk or b"\n" in chunk:
+                        break
+                line = None
+
+            try:
+                job = json.loads(line) if line is not None else None
+            except ValueError:
+                job = None
+            if line is None:
+                writer.write((json.dumps({"event": "error", "message": "The job is longer than the server accepts"}) +
+                              "\n").encode())
+            elif not isinstance(job, dict):
+                writer.write((json.dumps({"event": "error", "message": "Expected a job as a line of JSON"}) +
+                              "\n").encode())
+            else:
+                async for event in self.run(job):
+                    writer.write((json.dumps(event) + "\n").encode())
+                    await writer.drain()
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8765, limit: int = MAX_LINE_BYTES):
+        """
+        Starts accepting jobs on a local socket.
+
+        :param limit: The longest job line accepted, in bytes
+        :return: The asyncio server
+        """
+        return await asyncio.start_server(self.handle_client, host, port, limit=limit)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+async def submit_job(job: dict, host: str = "127.0.0.1", port: int = 8765,
+                     limit: int = MAX_LINE_BYTES) -> AsyncIterator[dict]:
+    """
+    Sends a job to a running job server and yields its events.
+
+    :param limit: The longest event line accepted, in bytes
+    """
+    reader, writer = await asyncio.open_connection(host, port, limit=limit)
+    try:
+        writer.write((json.dumps(job) + "\n").encode())
+        await writer.drain()
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            yield json.loads(line)
+    finally:
+        writer.close()
+
+
+async def serve_forever(port: int, cache_directory: str, max_cache_bytes: int, workers: int):
+    service = SimulationService(cache_directory, max_cache_bytes, workers)
+    server = await service.serve(port=port)
+    print("Accepting simulation jobs on 127.0.0.1:{}".format(port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local simulation job server")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--cache-dir", default=".simulation_cache")
+    parser.add_argument("--max-cache-mb", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=None)
+    arguments = parser.parse_args()
+
+    asyncio.run(serve_forever(arguments.port, arguments.cache_dir, arguments.max_cache_mb * 1024 * 1024,
+                              arguments.workers))
+
+
+if __name__ == "__main__":
+    main()
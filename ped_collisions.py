@@ -8,12 +8,27 @@ and Nicholas Wolf
 
 # !/usr/bin/python3
 
+import argparse
+import os
+import random
 from typing import Tuple
 
 from beautifultable import BeautifulTable
 
+from checkpoint import SimulationCheckpoint
 from city import (City, )
+from crowd import CrowdSimulation
 from pedestrian import Pedestrian
+from placement import (AmenityPlacement,
+                       accumulate_foot_traffic, )
+from routing import TiledRouter
+
+
+# City grids at least this size route pedestrians through a TiledRouter rather than searching the whole city graph.
+TILED_ROUTING_MIN_GRID_SIZE = 100
+
+# A crowd simulation is cut off after this many times the longest path plus the longest detour, in ticks.
+CROWD_TICK_LIMIT_FACTOR = 10
 
 
 def query_number_pedestrians(grid_size) -> Tuple[int, int]:
@@ -75,9 +90,64 @@ def query_number_simulations() -> int:
             print("Invalid response. Try again.")
 
 
-def run_simulation(city, num_peds):
+def query_node_capacity() -> int:
+    """
+    Function to query user for how many pedestrians a city location can hold at the same time
+    :return: integer greater than or equal to 0, 0 meaning pedestrians do not get in each other's way
+    """
+    while True:
+        node_capacity = input("Simulation Variable:\tPedestrians a location can hold at once (0 for unlimited): ")
+        try:
+            if int(node_capacity) >= 0:
+                return int(node_capacity)
+            else:
+                print("Invalid response.")
+        except:
+            print("Invalid response. Try again.")
+
+
+def query_amenity_sites() -> Tuple[int, int]:
+    """
+    Function to query user for how many amenity sites to recommend and how far each site's reach extends
+    :return: two-element Tuple of integers >= 0, the number of sites (0 to skip) and the coverage radius
+    """
+    while True:
+        num_sites = input("Do you wish to recommend amenity sites? Number of sites (0 to skip): ")
+        coverage_radius = input("Coverage radius of each site, in city blocks: ") if num_sites.strip() != "0" else "0"
+        try:
+            if int(num_sites) >= 0 and int(coverage_radius) >= 0:
+                return int(num_sites), int(coverage_radius)
+            else:
+                print("Invalid response.")
+        except:
+            print("Invalid response. Try again.")
+
+
+def print_amenity_sites(foot_traffic, num_sites, coverage_radius, city):
+    """
+    A helper function to pretty print the sites covering the most foot traffic over all simulations
+    :param foot_traffic: per node pedestrian counts summed over all simulations
+    :param num_sites: number of sites to recommend
+    :param coverage_radius: walking distance within which a site collects foot traffic
+    :param city: the city simulated, any unblocked location of which can be a site
+    :return: None (prints ASCII table)
+    """
+    print("\nRecommended Amenity Sites\n")
+    sites = AmenityPlacement.optimize(foot_traffic, num_sites, coverage_radius, city=city)
+
+    table = BeautifulTable()
+    table.column_headers = ["Site", "Location Node", "Pedestrians Covered"]
+    for site_number, (site, covered) in enumerate(sites, start=1):
+        table.append_row([str(site_number), str(site), str(covered)])
+    print(table)
+
+    print("\nThe {} sites cover {} of {} pedestrian passings within {} blocks.\n".format(
+        len(sites), sum(covered for site, covered in sites), sum(foot_traffic.values()), coverage_radius))
+
+
+def run_simulation(city, num_peds, router=None):
     print("Generating {} random pedestrians".format(num_peds))
-    pedestrians = Pedestrian.generate_random_pedestrians(num_peds, city)
+    pedestrians = Pedestrian.generate_random_pedestrians(num_peds, city, router)
 
     """
     We create a count of how many times a node (CityLocation object) appears in 
@@ -101,6 +171,51 @@ def run_simulation(city, num_peds):
     return sorted(intersect_dict.items(), key=lambda x: x[1], reverse=True)
 
 
+def run_crowd_simulation(city, num_peds, node_capacity, router=None):
+    """
+    Like run_simulation, but pedestrians walk their paths at the same time, one block per tick, and wait or detour
+    when a location already holds node_capacity pedestrians.
+    :return: (location, count) pairs sorted by count, as in run_simulation
+    """
+    print("Generating {} random pedestrians".format(num_peds))
+    pedestrians = Pedestrian.generate_random_pedestrians(num_peds, city, router)
+
+    crowd = CrowdSimulation.from_pedestrians(city, pedestrians, node_capacity)
+    longest_path = max((len(ped.shortest_path) for ped in pedestrians), default=0)
+    crowd.run(CROWD_TICK_LIMIT_FACTOR * (longest_path + crowd.max_detour))
+
+    return crowd.foot_traffic()
+
+
+def run_pedestrian_range(city, min_num_peds, max_num_peds, node_capacity=0, router=None, foot_traffic=None):
+    """
+    Runs a single simulation: one run for each number of pedestrians in the range, stopping early when a run finds
+    no pedestrian paths.
+    :param foot_traffic: when given, the per node counts of every run are added to it
+    :return: dict of the top location of each run, keyed by number of pedestrians
+    """
+    pedestrian_summary = {}
+    for num_peds in range(min_num_peds, max_num_peds + 1):
+
+        if node_capacity:
+            intersection_list = run_crowd_simulation(city, num_peds, node_capacity, router)
+        else:
+            intersection_list = run_simulation(city, num_peds, router)
+
+        if intersection_list:
+            if foot_traffic is not None:
+                accumulate_foot_traffic(intersection_list, foot_traffic)
+            pedestrian_summary[num_peds] = {
+                "Pedestrians": num_peds,
+                "City": city,
+                "Top_Location": intersection_list[0][0],
+                "Number_Collisions": intersection_list[0][1]
+            }
+        else:
+            break
+    return pedestrian_summary
+
+
 def query_output_preference():
     """
     Function to query user as to whether to print out grid image
@@ -173,51 +288,95 @@ def print_aggregate_statistics(simulation_summary, grid_size, city):
                                                                                            highest_collisions_of_all_simulations))
 
 
-def main():
-    size = query_size_grid()  # Query user for size of city grid
+def main(checkpoint_path=None, checkpoint_every=100, resume=False):
+    """
+    Runs the simulations the user asks for and prints their results.
+
+    :param checkpoint_path: Where to save the state of the run between simulations, None to not save it
+    :param checkpoint_every: Number of simulations between checkpoints, 0 to not save any
+    :param resume: Continue the run saved at checkpoint_path instead of starting a new one. The checkpoint is removed
+        once the run is complete.
+    """
+    if resume:
+        checkpoint = SimulationCheckpoint.load(checkpoint_path)  # Pick up the city and results of the saved run
+        random.setstate(checkpoint.random_state)
+        settings = checkpoint.settings
+        (size, num_simuls) = (settings["size"], settings["num_simuls"])
+        (min_num_peds, max_num_peds) = (settings["min_num_peds"], settings["max_num_peds"])
+        node_capacity = settings["node_capacity"]
+        (num_sites, coverage_radius) = (settings["num_sites"], settings["coverage_radius"])
+        city = checkpoint.city
+
+        print("--------------------")
+        print("Resuming after simulation {} of {}".format(len(checkpoint.simulation_summary), num_simuls))
+    else:
+        size = query_size_grid()  # Query user for size of city grid
+
+        num_simuls = query_number_simulations()  # Query user for number of simulations to run
+
+        (min_num_peds, max_num_peds) = query_number_pedestrians(size)  # Query user for number of pedestrians
 
-    num_simuls = query_number_simulations()  # Query user for number of simulations to run
+        node_capacity = query_node_capacity()  # Query user for how crowded a location can get
 
-    (min_num_peds, max_num_peds) = query_number_pedestrians(size)  # Query user for number of pedestrians
+        out_pref = query_output_preference()  # Query user as to whether to print view of city or output png/Gephi files
 
-    out_pref = query_output_preference()  # Query user as to whether to print view of city or output png/Gephi files
+        (num_sites, coverage_radius) = query_amenity_sites()  # Query user for amenity sites to recommend
 
-    print("--------------------")
-    print("Generating a random city")
-    city = City.generate_random_city(size, size)  # Build the city network
+        print("--------------------")
+        print("Generating a random city")
+        city = City.generate_random_city(size, size)  # Build the city network
 
-    if out_pref[0]:
-        print("\nHere is the randomly generated city grid that will be used for simulation (saved as city.png):\n")
-    city.print(out_pref[0], out_pref[1])  # Display city network if user requests
+        if out_pref[0]:
+            print("\nHere is the randomly generated city grid that will be used for simulation (saved as city.png):\n")
+        city.print(out_pref[0], out_pref[1])  # Display city network if user requests
 
-    simulation_summary = {}  # Container for all results summary
-    simulation = 1
+        checkpoint = SimulationCheckpoint({"size": size, "num_simuls": num_simuls, "min_num_peds": min_num_peds,
+                                           "max_num_peds": max_num_peds, "node_capacity": node_capacity,
+                                           "output_grid": out_pref[0], "output_graph": out_pref[1],
+                                           "num_sites": num_sites, "coverage_radius": coverage_radius}, city)
+
+    router = None
+    if size >= TILED_ROUTING_MIN_GRID_SIZE:
+        print("Precomputing routes within tiles of the city")
+        router = TiledRouter(city)  # Route pedestrians through tiles on large grids
+
+    simulation_summary = checkpoint.simulation_summary  # Container for all results summary
+    foot_traffic = checkpoint.foot_traffic  # Per node counts summed over all simulations
+    simulation = len(simulation_summary) + 1
     while simulation <= num_simuls:  # Run simulations and record results
 
         print("Running simulation {}".format(simulation))
 
-        pedestrian_summary = {}
-        for num_peds in range(min_num_peds, max_num_peds + 1):
+        simulation_summary[simulation] = run_pedestrian_range(city, min_num_peds, max_num_peds, node_capacity, router,
+                                                              foot_traffic)
 
-            intersection_list = run_simulation(city, num_peds)
-
-            if intersection_list:
-                pedestrian_summary[num_peds] = {
-                    "Pedestrians": num_peds,
-                    "City": city,
-                    "Top_Location": intersection_list[0][0],
-                    "Number_Collisions": intersection_list[0][1]
-                }
-            else:
-                break
-        simulation_summary[simulation] = pedestrian_summary
+        if checkpoint_path and checkpoint_every and simulation % checkpoint_every == 0 and simulation < num_simuls:
+            checkpoint.save(checkpoint_path)  # Save progress so an interrupted run can be resumed
         simulation += 1
 
     print_aggregate_statistics(simulation_summary, size, city)
 
+    if num_sites and foot_traffic:
+        print_amenity_sites(foot_traffic, num_sites, coverage_radius, city)
+
     simulation_reports = []
     simulation_reports.extend([report for report in simulation_summary.values()])
 
-
-if __name__ == main():
-    main()
+    if checkpoint_path and (checkpoint_every or resume) and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)  # The run is complete, so there is nothing left to resume
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monte Carlo simulation of pedestrian collisions in a city grid")
+    parser.add_argument("--checkpoint", default="simulation.checkpoint",
+                        help="file the state of the run is saved to between simulations")
+    parser.add_argument("--checkpoint-every", type=int, default=100,
+                        help="number of simulations between checkpoints, 0 to not save any")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the run saved in the checkpoint file instead of starting a new one")
+    args = parser.parse_args()
+    if args.checkpoint_every < 0:
+        parser.error("--checkpoint-every must not be negative")
+    if args.resume and not os.path.exists(args.checkpoint):
+        parser.error("there is no checkpoint to resume from at {}".format(args.checkpoint))
+    main(args.checkpoint, args.checkpoint_every, args.resume)
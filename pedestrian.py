@@ -70,7 +70,7 @@ class Pedestrian(object):
         return [location for location in city.city_graph if filter_criteria(location)]
 
     @classmethod
-    def generate_random_pedestrians(cls, num_peds, city: City) -> List:
+    def generate_random_pedestrians(cls, num_peds, city: City, router=None) -> List:
         """
         Generates random pedestrians at random city locations with random destinations.
 
@@ -85,6 +85,7 @@ class Pedestrian(object):
 
         :param num_peds: The number of pedestrians to generate
         :param city: The city to generate pedestrians in.
+        :param router: A TiledRouter of city to find shortest paths with, instead of searching the whole city graph
         :return: A List of random Pedestrians
         """
 
@@ -120,12 +121,14 @@ class Pedestrian(object):
         """
         To account for generated nodes with blockages, we run the simulation on a copy of the city grid
         where blocked nodes have been removed so that shortest paths for pedestrians will only include
-        open pathways
+        open pathways. A router already leaves blocked nodes out, so there is no need for the copy then.
         """
-        blocked_nodes = [i for i in city.city_graph.nodes() if CityLocation.is_blocked(i) == True]
+        city_unblocked = None
+        if router is None:
+            blocked_nodes = [i for i in city.city_graph.nodes() if CityLocation.is_blocked(i) == True]
 
-        city_unblocked = city.city_graph.copy(as_view=False)
-        city_unblocked.remove_nodes_from(blocked_nodes)
+            city_unblocked = city.city_graph.copy(as_view=False)
+            city_unblocked.remove_nodes_from(blocked_nodes)
 
         """
         We now initiate all of our pedestrians, assigning each one of the random pairs of start/end points
@@ -142,7 +145,7 @@ class Pedestrian(object):
             commute = PedestrianCommute(start, end)
             try:
                 pedestrians.append(Pedestrian("Ped" + str(ped_num), city, start, end,
-                                              cls.get_shortest_path_from_cache(city_unblocked, commute)))
+                                              cls.get_shortest_path_from_cache(city_unblocked, commute, router)))
             except nx.NetworkXNoPath as e:
                 e
             finally:
@@ -151,7 +154,11 @@ class Pedestrian(object):
         return pedestrians
 
     @classmethod
-    def get_shortest_path_from_cache(cls, city_graph: nx.Graph, commute: PedestrianCommute) -> list:
+    def get_shortest_path_from_cache(cls, city_graph: nx.Graph, commute: PedestrianCommute, router=None) -> list:
+        # A router keeps its own cache of paths, which it keeps up to date as locations are blocked or unblocked.
+        if router is not None:
+            return router.shortest_path(commute.start_location, commute.destination)
+
         path = path_cache.get(commute, None)
 
         if path is None:
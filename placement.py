@@ -0,0 +1,185 @@
+from typing import (Dict,
+                    Iterable,
+                    List,
+                    Tuple, )
+
+import numpy as np
+
+from city import (City,
+                  CityLocation, )
+
+
+def accumulate_foot_traffic(intersection_list: Iterable[Tuple[CityLocation, int]],
+                            foot_traffic: Dict[CityLocation, int] = None) -> Dict[CityLocation, int]:
+    """
+    Adds the per node counts of a single simulation (as returned by run_simulation) to a running total.
+
+    >>> from city import GeoLocation, CityLocationType
+    >>> a = CityLocation(GeoLocation(0, 0), CityLocationType.walkway)
+    >>> b = CityLocation(GeoLocation(0, 1), CityLocationType.walkway)
+    >>> accumulate_foot_traffic([(a, 2)], accumulate_foot_traffic([(a, 1), (b, 3)]))
+    {walkway, (0, 0): 3, walkway, (0, 1): 3}
+
+    :param intersection_list: (location, count) pairs of a simulation
+    :param foot_traffic: The running total to add to, a new one is created when absent
+    :return: The updated running total
+    """
+    if foot_traffic is None:
+        foot_traffic = {}
+    for location, count in intersection_list:
+        foot_traffic[location] = foot_traffic.get(location, 0) + count
+    return foot_traffic
+
+
+def diamond_sums(grid: np.ndarray, radius: int) -> np.ndarray:
+    """
+    For every cell of grid, sums the cells within radius blocks of walking distance (cells outside the grid count as
+    0). Each row offset of the diamond is one windowed sum over the running row totals, so this is O(radius) passes over
+    the grid rather than O(radius^2).
+
+    >>> diamond_sums(np.array([[1, 2, 3], [4, 5, 6]]), 1)
+    array([[ 7, 11, 11],
+           [10, 17, 14]])
+
+    :param grid: 2D array of values per city block
+    :param radius: The walking distance to sum over
+    :return: 2D array of the same shape holding the sums
+    """
+    rows, columns = grid.shape
+    padded = np.zeros((rows + 2 * radius, columns + 2 * radius + 1), dtype=grid.dtype)
+    padded[radius:radius + rows, radius + 1:radius + 1 + columns] = grid
+    running = np.cumsum(padded, axis=1)
+
+    sums = np.zeros_like(grid)
+    for row_offset in range(-radius, radius + 1):
+        width = radius - abs(row_offset)
+        shifted = running[radius + row_offset:radius + row_offset + rows]
+        sums += shifted[:, radius + width + 1:radius + width + 1 + columns] - shifted[:, radius - width:radius - width + columns]
+    return sums
+
+
+def diamond_mask(radius: int) -> np.ndarray:
+    """
+    The cells within radius blocks of walking distance of the center of a (2 * radius + 1) square.
+
+    >>> diamond_mask(1).astype(int)
+    array([[0, 1, 0],
+           [1, 1, 1],
+           [0, 1, 0]])
+    """
+    offsets = np.abs(np.arange(-radius, radius + 1))
+    return offsets[:, None] + offsets[None, :] <= radius
+
+
+class AmenityPlacement(object):
+    """
+    Selects sites for businesses or amenities that together cover the most foot traffic.
+
+    A site covers every location within coverage_radius blocks of it, and every location's foot traffic is only
+    counted once no matter how many sites cover it. This makes the covered traffic a submodular function of the set
+    of sites, so it is maximized greedily, picking the site with the largest gain each round.
+
+    Gains are kept in an array laid out like the city grid, which doubles as the spatial index for coverage radii.
+    Picking a site only changes the gains of sites within 2 * coverage_radius of it, so only that window is
+    recomputed each round; the rest of the gains are carried over untouched from earlier rounds.
+
+    >>> from city import GeoLocation, CityLocationType
+    >>> grid = [[CityLocation(GeoLocation(row, column), CityLocationType.walkway) for column in range(6)]
+    ...         for row in range(1)]
+    >>> traffic = {grid[0][0]: 5, grid[0][1]: 4, grid[0][2]: 1, grid[0][5]: 3}
+    >>> AmenityPlacement.optimize(traffic, 2)
+    [(walkway, (0, 0), 5), (walkway, (0, 1), 4)]
+    >>> AmenityPlacement.optimize(traffic, 2, coverage_radius=1)
+    [(walkway, (0, 1), 10), (walkway, (0, 5), 3)]
+    >>> AmenityPlacement.optimize(traffic, 2, min_spacing=2)
+    [(walkway, (0, 0), 5), (walkway, (0, 5), 3)]
+
+    Given the city, any of its unblocked locations can be a site, including ones no pedestrian walked through.
+
+    >>> AmenityPlacement.optimize({grid[0][0]: 5, grid[0][2]: 5}, 1, coverage_radius=1)
+    [(walkway, (0, 0), 5)]
+    >>> AmenityPlacement.optimize({grid[0][0]: 5, grid[0][2]: 5}, 1, coverage_radius=1, city=City(grid))
+    [(walkway, (0, 1), 10)]
+    """
+
+    @classmethod
+    def optimize(cls, foot_traffic: Dict[CityLocation, int], num_sites: int, coverage_radius: int = 0,
+                 min_spacing: int = 0, candidates: Iterable[CityLocation] = None,
+                 city: City = None) -> List[Tuple[CityLocation, int]]:
+        """
+        Picks up to num_sites locations maximizing the total foot traffic covered.
+
+        :param foot_traffic: Per location pedestrian counts, e.g. summed over run_simulation results
+        :param num_sites: The number of sites to pick
+        :param coverage_radius: Walking distance from a site within which its foot traffic is counted
+        :param min_spacing: Sites must be at least this many blocks apart, 0 for no restriction
+        :param candidates: Locations allowed as sites, defaults to every unblocked location of city
+        :param city: The city the foot traffic was counted in; without it only locations with foot traffic are candidates
+        :return: List of (site, foot traffic newly covered by site) in the order the sites were picked
+        """
+        if candidates is None:
+            locations = (location for row in city.grid_map for location in row) if city is not None else foot_traffic
+            candidates = [location for location in locations if not location.is_blocked()]
+
+        candidate_at = {(location.geo_location.latitude, location.geo_location.longitude): location
+                        for location in candidates}
+        if not candidate_at:
+            return []
+
+        rows = 1 + max(max(latitude for latitude, longitude in candidate_at),
+                       max((location.geo_location.latitude for location in foot_traffic), default=0))
+        columns = 1 + max(max(longitude for latitude, longitude in candidate_at),
+                          max((location.geo_location.longitude for location in foot_traffic), default=0))
+
+        traffic = np.zeros((rows, columns), dtype=np.int64)
+        for location, count in foot_traffic.items():
+            traffic[location.geo_location.latitude, location.geo_location.longitude] += count
+
+        allowed = np.zeros((rows, columns), dtype=bool)
+        allowed[tuple(np.array(list(candidate_at)).T)] = True
+
+        gains = diamond_sums(traffic, coverage_radius)
+        coverage = diamond_mask(coverage_radius)
+        spacing = diamond_mask(min_spacing - 1) if min_spacing > 0 else None
+
+        sites = []
+        while len(sites) < num_sites:
+            best = int(np.argmax(np.where(allowed, gains, -1)))
+            row, column = divmod(best, columns)
+            if not allowed[row, column] or gains[row, column] <= 0:
+                break
+
+            sites.append((candidate_at[(row, column)], int(gains[row, column])))
+
+            cls.clear_diamond(traffic, row, column, coverage_radius, coverage, 0)
+            if spacing is not None:
+                cls.clear_diamond(allowed, row, column, min_spacing - 1, spacing, False)
+
+            # Only sites that share covered blocks with the new site lose gain.
+            reach = 2 * coverage_radius
+            top, bottom = max(0, row - reach), min(rows, row + reach + 1)
+            left, right = max(0, column - reach), min(columns, column + reach + 1)
+            outer_top, outer_left = max(0, top - coverage_radius), max(0, left - coverage_radius)
+            window = diamond_sums(traffic[outer_top:min(rows, bottom + coverage_radius),
+                                          outer_left:min(columns, right + coverage_radius)], coverage_radius)
+            gains[top:bottom, left:right] = window[top - outer_top:bottom - outer_top,
+                                                   left - outer_left:right - outer_left]
+
+        return sites
+
+    @classmethod
+    def clear_diamond(cls, grid: np.ndarray, row: int, column: int, radius: int, mask: np.ndarray, value):
+        """
+        Sets every cell of grid within radius blocks of (row, column) to value.
+
+        :param grid: The 2D array to update in place
+        :param row: Row of the center
+        :param column: Column of the center
+        :param radius: The walking distance to clear
+        :param mask: diamond_mask(radius)
+        :param value: The value to store
+        """
+        top, left = max(0, row - radius), max(0, column - radius)
+        bottom, right = min(grid.shape[0], row + radius + 1), min(grid.shape[1], column + radius + 1)
+        window = mask[top - row + radius:bottom - row + radius, left - column + radius:right - column + radius]
+        grid[top:bottom, left:right][window] = value
@@ -0,0 +1,401 @@
+import heapq
+from collections import OrderedDict
+from typing import (Iterable,
+                    List,
+                    Tuple, )
+
+import networkx as nx
+import numpy as np
+
+from city import (City,
+                  CityLocation, )
+
+# Distance used for locations that have not been reached (yet).
+UNREACHED = np.int64(np.iinfo(np.int64).max // 4)
+
+
+def distances_within(passable: np.ndarray, sources: np.ndarray) -> np.ndarray:
+    """
+    Breadth first search from each source over the passable cells of a small grid, all sources at once: every step
+    grows every source's frontier by one block in all four directions.
+
+    >>> distances_within(np.array([[True, True, True], [False, False, True]]), np.array([[0, 0], [1, 2]]))
+    array([[[ 0,  1,  2],
+            [-1, -1,  3]],
+    <BLANKLINE>
+           [[ 3,  2,  1],
+            [-1, -1,  0]]], dtype=int32)
+
+    :param passable: 2D array, True where a cell can be walked through
+    :param sources: (row, column) of each source
+    :return: Distances in blocks from each source to every cell, -1 where unreachable
+    """
+    distances = np.full((len(sources),) + passable.shape, -1, dtype=np.int32)
+    frontier = np.zeros(distances.shape, dtype=bool)
+    frontier[np.arange(len(sources)), sources[:, 0], sources[:, 1]] = True
+    distances[frontier] = 0
+
+    steps = 0
+    while frontier.any():
+        steps += 1
+        grown = np.zeros_like(frontier)
+        grown[:, 1:, :] |= frontier[:, :-1, :]
+        grown[:, :-1, :] |= frontier[:, 1:, :]
+        grown[:, :, 1:] |= frontier[:, :, :-1]
+        grown[:, :, :-1] |= frontier[:, :, 1:]
+        frontier = grown & passable & (distances < 0)
+        distances[frontier] = steps
+    return distances
+
+
+class Tile(object):
+    """
+    A square block of the city grid, along with the shortest distances within the tile between its border cells
+    (the unblocked cells on the tile's edges that face another tile).
+    """
+
+    def __init__(self, top: int, left: int, bottom: int, right: int, rows: int, columns: int):
+        self.top, self.left, self.bottom, self.right = top, left, bottom, right
+        self.faces_up, self.faces_down = top > 0, bottom < rows
+        self.faces_left, self.faces_right = left > 0, right < columns
+
+    def build(self, passable: np.ndarray):
+        """
+        (Re)computes the border cells of the tile and the distances between them.
+
+        :param passable: The tile's cells, True where a cell can be walked through
+        """
+        self.passable = passable
+        edge = np.zeros(passable.shape, dtype=bool)
+        edge[0, :] |= self.faces_up
+        edge[-1, :] |= self.faces_down
+        edge[:, 0] |= self.faces_left
+        edge[:, -1] |= self.faces_right
+
+        self.borders = np.argwhere(edge & passable)
+        self.border_at = np.full(passable.shape, -1, dtype=np.int64)
+        self.border_at[self.borders[:, 0], self.borders[:, 1]] = np.arange(len(self.borders))
+        self.border_rows = self.borders[:, 0] + self.top
+        self.border_columns = self.borders[:, 1] + self.left
+
+        if len(self.borders):
+            self.distances = distances_within(passable, self.borders)[:, self.borders[:, 0], self.borders[:, 1]]
+        else:
+            self.distances = np.zeros((0, 0), dtype=np.int32)
+
+    def local(self, cell: Tuple[int, int]) -> Tuple[int, int]:
+        return cell[0] - self.top, cell[1] - self.left
+
+
+class TiledRouter(object):
+    """
+    Answers shortest path queries on a city grid through an overlay of tiles, so that each query only searches the
+    border cells of the tiles between the two locations instead of the whole city.
+
+    The grid is cut into tile_size x tile_size tiles, and for every tile the distances within the tile between all
+    of its border cells are computed up front. A query searches tile by tile: whenever the distance to some border
+    cells of a tile improves, the tile's distance matrix gives the distances to all its other border cells, and
+    those cross into the neighbouring tiles. Tiles are searched closest first, counting the straight line (Manhattan)
+    distance still to go, and the search stops once no tile left can lead to a shorter path. The path found is then
+    unpacked into every location along the way, walking within each tile it passes through.
+
+    Blocking or unblocking locations only changes the tiles they are in, so update only rebuilds those tiles.
+
+    Paths found are kept around, least recently used ones being dropped past cached_paths, as pedestrians often share
+    a commute. Blocking locations drops the paths through them; unblocking any location drops every path, as it may
+    have opened a shorter way for any of them.
+
+    >>> import random
+    >>> random.seed(3)
+    >>> city = City.generate_random_city(30, 30)
+    >>> unblocked = city.city_graph.subgraph([location for location in city.city_graph if not location.is_blocked()])
+    >>> router = TiledRouter(city, tile_size=8)
+    >>> open_locations = list(unblocked)
+    >>> commutes = [random.sample(open_locations, 2) for _ in range(50)]
+    >>> all(len(router.shortest_path(start, end)) == len(nx.shortest_path(unblocked, start, end))
+    ...     for start, end in commutes if nx.has_path(unblocked, start, end))
+    True
+    >>> path = router.shortest_path(*commutes[0])
+    >>> all(unblocked.has_edge(a, b) for a, b in zip(path, path[1:]))
+    True
+    >>> router.shortest_path(*commutes[0]) is path
+    True
+    >>> from city import CityLocationType
+    >>> path[1].location_type = CityLocationType.blockage
+    >>> router.update([path[1]])
+    >>> path[1] in router.shortest_path(*commutes[0])
+    False
+    >>> small = TiledRouter(city, tile_size=8, cached_paths=2)
+    >>> for start, end in commutes[1:6]:
+    ...     small.shortest_path(start, end) and None
+    >>> len(small.paths)
+    2
+    """
+
+    def __init__(self, city: City, tile_size: int = 32, cached_fields: int = 4096, cached_paths: int = 4096):
+        """
+        :param city: The city to route in
+        :param tile_size: Rows and columns of the grid per tile
+        :param cached_fields: How many distance fields within a tile to keep around for unpacking paths
+        :param cached_paths: How many paths found to keep around for commutes asked for again
+        """
+        self.grid_map = city.grid_map
+        self.rows, self.columns = len(city.grid_map), len(city.grid_map[0])
+        self.tile_size = tile_size
+        self.cell_of = {id(location): (row, column) for row, locations in enumerate(city.grid_map)
+                        for column, location in enumerate(locations)}
+        self.passable = np.array([[not location.is_blocked() for location in row] for row in city.grid_map],
+                                 dtype=bool)
+
+        self.tiles = {}
+        for tile_row in range(0, (self.rows + tile_size - 1) // tile_size):
+            for tile_column in range(0, (self.columns + tile_size - 1) // tile_size):
+                top, left = tile_row * tile_size, tile_column * tile_size
+                self.tiles[(tile_row, tile_column)] = Tile(top, left, min(top + tile_size, self.rows),
+                                                           min(left + tile_size, self.columns), self.rows,
+                                                           self.columns)
+                self.rebuild_tile((tile_row, tile_column))
+
+        self.cached_fields = cached_fields
+        self.fields = OrderedDict()
+        self.cached_paths = cached_paths
+        self.paths = OrderedDict()
+
+    def tile_of(self, cell: Tuple[int, int]) -> Tuple[int, int]:
+        return cell[0] // self.tile_size, cell[1] // self.tile_size
+
+    def rebuild_tile(self, tile_key: Tuple[int, int]):
+        tile = self.tiles[tile_key]
+        tile.build(self.passable[tile.top:tile.bottom, tile.left:tile.right].copy())
+
+    def update(self, locations: Iterable[CityLocation]):
+        """
+        Picks up changes to whether the given locations are blocked, rebuilding only the tiles they are in.
+
+        :param locations: City locations whose location type changed
+        """
+        changed, blocked, unblocked = set(), set(), False
+        for location in locations:
+            cell = self.cell_of[id(location)]
+            if location.is_blocked():
+                blocked.add(id(location))
+            else:
+                unblocked = unblocked or not self.passable[cell]
+            self.passable[cell] = not location.is_blocked()
+            changed.add(self.tile_of(cell))
+
+        for tile_key in changed:
+            self.rebuild_tile(tile_key)
+        for field_key in [field_key for field_key in self.fields if field_key[0] in changed]:
+            del self.fields[field_key]
+
+        if unblocked:
+            self.paths.clear()
+        for commute in [commute for commute, path in self.paths.items()
+                        if any(id(location) in blocked for location in path)]:
+            del self.paths[commute]
+
+    def field_to(self, tile_key: Tuple[int, int], cell: Tuple[int, int]) -> np.ndarray:
+        """
+        Distances within a tile to one of its cells, least recently used ones being dropped past cached_fields.
+        """
+        field = self.fields.get((tile_key, cell))
+        if field is None:
+            tile = self.tiles[tile_key]
+            field = distances_within(tile.passable, np.array([tile.local(cell)]))[0]
+            self.fields[(tile_key, cell)] = field
+            if len(self.fields) > self.cached_fields:
+                self.fields.popitem(last=False)
+        else:
+            self.fields.move_to_end((tile_key, cell))
+        return field
+
+    def cross_links(self, tile_key: Tuple[int, int]) -> List[Tuple[Tuple[int, int], np.ndarray, np.ndarray]]:
+        """
+        The steps from the border cells of a tile into the border cells of its neighbouring tiles.
+
+        :param tile_key: The tile to step out of
+        :return: List of (neighbouring tile, border indices in this tile, border indices in the neighbouring tile)
+        """
+        tile = self.tiles[tile_key]
+        links = []
+        for row_step, column_step in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+            neighbour_key = (tile_key[0] + row_step, tile_key[1] + column_step)
+            neighbour = self.tiles.get(neighbour_key)
+            if neighbour is None:
+                continue
+
+            if row_step:
+                own_edge = tile.border_at[0 if row_step < 0 else -1, :]
+                other_edge = neighbour.border_at[-1 if row_step < 0 else 0, :]
+            else:
+                own_edge = tile.border_at[:, 0 if column_step < 0 else -1]
+                other_edge = neighbour.border_at[:, -1 if column_step < 0 else 0]
+            linked = (own_edge >= 0) & (other_edge >= 0)
+            links.append((neighbour_key, own_edge[linked], other_edge[linked]))
+        return links
+
+    def shortest_path(self, source: CityLocation, destination: CityLocation) -> List[CityLocation]:
+        """
+        Finds a shortest path between two locations walking only through unblocked locations, like
+        nx.shortest_path on the city graph with blocked locations removed.
+
+        :param source: The location to start from
+        :param destination: The location to get to
+        :return: List of locations from source to destination
+        """
+        start, end = self.cell_of[id(source)], self.cell_of[id(destination)]
+        path = self.paths.get((start, end))
+        if path is None:
+            path = self.search(source, destination, start, end)
+            self.paths[(start, end)] = path
+            if len(self.paths) > self.cached_paths:
+                self.paths.popitem(last=False)
+        else:
+            self.paths.move_to_end((start, end))
+        return path
+
+    def search(self, source: CityLocation, destination: CityLocation, start: Tuple[int, int],
+               end: Tuple[int, int]) -> List[CityLocation]:
+        """
+        The tile by tile search of shortest_path, for commutes that are not cached.
+        """
+        if not self.passable[start] or not self.passable[end]:
+            raise nx.NetworkXNoPath("No path between {} and {}.".format(source, destination))
+        if start == end:
+            return [source]
+
+        start_key, end_key = self.tile_of(start), self.tile_of(end)
+        start_tile, end_tile = self.tiles[start_key], self.tiles[end_key]
+        from_start = distances_within(start_tile.passable, np.array([start_tile.local(start)]))[0]
+        to_end = self.field_to(end_key, end)
+
+        best, best_border = UNREACHED, None
+        if start_key == end_key and to_end[start_tile.local(start)] >= 0:
+            best = int(to_end[start_tile.local(start)])
+
+        """
+        Per tile searched so far: the shortest distance found from start to each border cell, the border cell it was
+        reached from (-1 for directly from start), and which border cells improved since the tile was last searched.
+        """
+        distance, reached_from, pending = {}, {}, {}
+        heap = []
+
+        def labels(tile_key):
+            if tile_key not in distance:
+                size = len(self.tiles[tile_key].borders)
+                distance[tile_key] = np.full(size, UNREACHED, dtype=np.int64)
+                reached_from[tile_key] = np.full(size, -1, dtype=np.int64)
+                pending[tile_key] = np.zeros(size, dtype=bool)
+            return distance[tile_key], reached_from[tile_key], pending[tile_key]
+
+        def schedule(tile_key):
+            tile = self.tiles[tile_key]
+            waiting = pending[tile_key]
+            remaining = np.abs(tile.border_rows[waiting] - end[0]) + np.abs(tile.border_columns[waiting] - end[1])
+            heapq.heappush(heap, (int(np.min(distance[tile_key][waiting] + remaining)), tile_key))
+
+        start_distance, _, start_pending = labels(start_key)
+        start_distance[:] = np.where(from_start[start_tile.borders[:, 0], start_tile.borders[:, 1]] >= 0,
+                                     from_start[start_tile.borders[:, 0], start_tile.borders[:, 1]], UNREACHED)
+        start_pending[:] = start_distance < UNREACHED
+        if start_pending.any():
+            schedule(start_key)
+        to_end_borders = np.where(to_end[end_tile.borders[:, 0], end_tile.borders[:, 1]] >= 0,
+                                  to_end[end_tile.borders[:, 0], end_tile.borders[:, 1]], UNREACHED)
+
+        while heap:
+            bound, tile_key = heapq.heappop(heap)
+            if bound >= best:
+                break
+            tile_distance, tile_reached_from, tile_pending = labels(tile_key)
+            entries = np.flatnonzero(tile_pending)
+            if len(entries) == 0:
+                continue
+            tile_pending[:] = False
+            tile = self.tiles[tile_key]
+
+            through = np.where(tile.distances[entries] >= 0,
+                               tile_distance[entries][:, None] + tile.distances[entries], UNREACHED)
+            closest = through.min(axis=0)
+            improved = closest < tile_distance
+            tile_distance[improved] = closest[improved]
+            entry_cells = tile.border_rows[entries] * self.columns + tile.border_columns[entries]
+            tile_reached_from[improved] = entry_cells[through.argmin(axis=0)[improved]]
+
+            if tile_key == end_key:
+                total = tile_distance + to_end_borders
+                closest_to_end = int(np.argmin(total))
+                if total[closest_to_end] < best:
+                    best, best_border = int(total[closest_to_end]), closest_to_end
+
+            leaving = np.zeros(len(tile_distance), dtype=bool)
+            leaving[entries] = True
+            leaving |= improved
+            for neighbour_key, own, other in self.cross_links(tile_key):
+                own, other = own[leaving[own]], other[leaving[own]]
+                if len(own) == 0:
+                    continue
+                neighbour_distance, neighbour_reached_from, neighbour_pending = labels(neighbour_key)
+                stepped = tile_distance[own] + 1
+                better = stepped < neighbour_distance[other]
+                if better.any():
+                    neighbour_distance[other[better]] = stepped[better]
+                    neighbour_reached_from[other[better]] = (tile.border_rows[own[better]] * self.columns +
+                                                             tile.border_columns[own[better]])
+                    neighbour_pending[other[better]] = True
+                    schedule(neighbour_key)
+
+        if best >= UNREACHED:
+            raise nx.NetworkXNoPath("No path between {} and {}.".format(source, destination))
+
+        if best_border is None:
+            cells = self.walk(start_key, start, to_end)
+        else:
+            cells = self.unpack(start, end, best_border, from_start, to_end, reached_from)
+        return [self.grid_map[row][column] for row, column in cells]
+
+    def unpack(self, start: Tuple[int, int], end: Tuple[int, int], last_border: int, from_start: np.ndarray,
+               to_end: np.ndarray, reached_from: dict) -> List[Tuple[int, int]]:
+        """
+        Expands the border cells a query went through into every cell along the way.
+        """
+        end_tile = self.tiles[self.tile_of(end)]
+        borders = [(int(end_tile.border_rows[last_border]), int(end_tile.border_columns[last_border]))]
+        while True:
+            tile_key = self.tile_of(borders[-1])
+            tile = self.tiles[tile_key]
+            previous = reached_from[tile_key][tile.border_at[tile.local(borders[-1])]]
+            if previous < 0:
+                break
+            borders.append(divmod(int(previous), self.columns))
+        borders.reverse()
+
+        cells = self.walk(self.tile_of(start), borders[0], from_start)[::-1]
+        for previous, border in zip(borders, borders[1:]):
+            tile_key = self.tile_of(border)
+            if tile_key != self.tile_of(previous):
+                cells.append(border)
+            else:
+                cells.extend(self.walk(tile_key, previous, self.field_to(tile_key, border))[1:])
+        cells.extend(self.walk(self.tile_of(end), borders[-1], to_end)[1:])
+        return cells
+
+    def walk(self, tile_key: Tuple[int, int], cell: Tuple[int, int], field: np.ndarray) -> List[Tuple[int, int]]:
+        """
+        Walks downhill through a distance field within a tile, from cell to the cell at distance 0.
+
+        :return: List of cells from cell to the field's source
+        """
+        tile = self.tiles[tile_key]
+        row, column = tile.local(cell)
+        height, width = field.shape
+        cells = [cell]
+        while field[row, column] > 0:
+            for next_row, next_column in ((row - 1, column), (row + 1, column), (row, column - 1), (row, column + 1)):
+                if 0 <= next_row < height and 0 <= next_column < width and \
+                        field[next_row, next_column] == field[row, column] - 1:
+                    row, column = next_row, next_column
+                    break
+            cells.append((row + tile.top, column + tile.left))
+        return cells